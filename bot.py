@@ -1,15 +1,20 @@
 import asyncio
-import json
 import logging
 import os
-from dataclasses import dataclass, is_dataclass, asdict, field
-from typing import Dict, List
+import signal
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
 
+import orjson
+import uvloop
 from aiogram import Bot, Dispatcher, executor, types
 from aiogram.utils.callback_data import CallbackData
-from aiohttp import ClientSession
+from aiogram.utils.exceptions import RetryAfter, TelegramAPIError
+from aiohttp import ClientResponseError, ClientSession, TCPConnector
 from tweety.bot import Twitter, UserTweets, Tweet
 from tweety.builder import UrlBuilder
+from tweety.exceptions_ import GuestTokenNotFound, InvalidCredentials, UnknownError
 
 CHATS_PATH = os.getenv('CHATS_PATH') or "chats.json"
 
@@ -18,8 +23,14 @@ TWEET_PARAMS = {"tweet.fields": "lang",
                 "expansions": "attachments.media_keys,author_id",
                 "user.fields": "username"}
 
+SERIALIZE_DELAY = 5
+MAX_CONCURRENT_REQUESTS = 64
+GUEST_TOKEN_TTL = 60 * 60
+SEND_WORKERS = 4
+SEND_INTERVAL = 1 / 30
 
-@dataclass
+
+@dataclass(slots=True)
 class Chat:
     id: int
     last_sent_id: Dict[str, int]
@@ -30,36 +41,74 @@ class Chat:
 
 bot = Bot(token=os.environ['TELEGRAM_BOT_ID'])
 dp = Dispatcher(bot)
-chats: Dict[str, Chat] = dict()
+chats: Dict[int, Chat] = dict()
 edit_subscription = CallbackData('subscription', 'chat_id', 'name', 'action')
 edit_filter = CallbackData('filter', 'chat_id', 'subscription', 'action', 'idx')
 search_cb = CallbackData('search', 'chat_id', 'subscription')
 forward_tasks = dict()
+background_tasks: List[asyncio.Task] = list()
+chats_dirty = asyncio.Event()
+session: Optional[ClientSession] = None
+requests_limit = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+send_queue = asyncio.Queue()
+next_send = 0.0
+url_builder = UrlBuilder()
+guest_token: Optional[str] = None
+guest_token_expires = 0.0
+guest_token_lock = asyncio.Lock()
+twitter: Optional[Twitter] = None
+twitter_created = 0.0
 
 
 class TryAgain(Exception):
     pass
 
 
-class EnhancedJSONEncoder(json.JSONEncoder):
-    def default(self, o):
-        if is_dataclass(o):
-            return asdict(o)
-        return super().default(o)
-
-
 def serialize():
-    with open(CHATS_PATH, "w") as fout:
-        json.dump(chats, fout, cls=EnhancedJSONEncoder)
+    tmp_path = CHATS_PATH + ".tmp"
+    with open(tmp_path, "wb") as fout:
+        fout.write(orjson.dumps(chats, option=orjson.OPT_NON_STR_KEYS))
+    os.replace(tmp_path, CHATS_PATH)
+
+
+async def serialize_loop():
+    try:
+        while True:
+            await chats_dirty.wait()
+            await asyncio.sleep(SERIALIZE_DELAY)
+            chats_dirty.clear()
+            try:
+                serialize()
+            except Exception:
+                logging.exception("Saving chats failed")
+                chats_dirty.set()
+    finally:
+        if chats_dirty.is_set():
+            serialize()
 
 
 def deserialize():
     global chats
     if os.path.exists(CHATS_PATH):
-        with open(CHATS_PATH, "r") as fout:
-            chats = {k: Chat(**v) for k, v in json.load(fout).items()}
+        with open(CHATS_PATH, "rb") as fout:
+            chats = {int(k): Chat(**v) for k, v in orjson.loads(fout.read()).items()}
+
+    logging.info("chats=%r", chats)
+
+
+def get_twitter() -> Twitter:
+    global twitter, twitter_created
+    if twitter is None or time.monotonic() - twitter_created > GUEST_TOKEN_TTL:
+        twitter = Twitter()
+        twitter_created = time.monotonic()
+    return twitter
+
 
-    logging.info(f"{chats=}")
+def matches_filters(text: str, filters: List[str]) -> bool:
+    if not filters:
+        return True
+    text = text.lower()
+    return any(term in text for term in filters)
 
 
 async def send_tweet(data: Tweet, chat: Chat):
@@ -70,7 +119,8 @@ async def send_tweet(data: Tweet, chat: Chat):
         if len(urls) > 1:
             media = types.MediaGroup()
             media.attach_photo(urls[0], caption=text)
-            list(map(media.attach_photo, urls[1:]))
+            for url in urls[1:]:
+                media.attach_photo(url)
             await bot.send_media_group(chat.id, media=media)
         else:
             await bot.send_photo(chat.id, urls[0], caption=text)
@@ -78,21 +128,72 @@ async def send_tweet(data: Tweet, chat: Chat):
         await bot.send_message(chat.id, text=text)
 
 
-async def get_tweets(user_id: int) -> List[Tweet]:
-    async with ClientSession() as session:
-        async def _call(p: dict):
-            async with session.request(
-                    method=p['method'].lower(),
-                    url=p['url'],
-                    headers=p['headers']) as r:
-                return await r.json()
+async def send_tweet_limited(data: Tweet, chat: Chat):
+    global next_send
+    while True:
+        # a media group is delivered as one message per photo
+        now = time.monotonic()
+        start = max(now, next_send)
+        next_send = start + SEND_INTERVAL * max(len(data.media), 1)
+        await asyncio.sleep(start - now)
+        try:
+            return await send_tweet(data, chat)
+        except RetryAfter as e:
+            await asyncio.sleep(e.timeout)
+
+
+async def send_tweets(to_send: List[Tuple[Chat, Tweet, int]]):
+    for chat, tweet, user_id in to_send:
+        try:
+            await send_tweet_limited(tweet, chat)
+        except TelegramAPIError:
+            # retrying on the next poll would fail the same way, skip the tweet
+            logging.exception("Sending tweet %s to chat %s failed", tweet.id, chat.id)
+        chat.last_sent_id[str(user_id)] = max(int(tweet.id), chat.last_sent_id.get(str(user_id), 0))
+        chats_dirty.set()
+
+
+async def send_loop():
+    while True:
+        to_send = await send_queue.get()
+        try:
+            await send_tweets(to_send)
+        except Exception:
+            logging.exception("Sending tweets failed")
+        finally:
+            send_queue.task_done()
+
+
+async def call_twitter(p: dict):
+    async with requests_limit, session.request(
+            method=p['method'].lower(),
+            url=p['url'],
+            headers=p['headers'],
+            raise_for_status=True) as r:
+        return await r.json(loads=orjson.loads)
 
-        builder = UrlBuilder()
-        token = await _call(builder.get_guest_token())
 
-        builder.guest_token = token['guest_token']
+async def get_guest_token(stale: Optional[str] = None) -> str:
+    global guest_token, guest_token_expires
+    async with guest_token_lock:
+        if guest_token is None or guest_token == stale or time.monotonic() > guest_token_expires:
+            url_builder.guest_token = None
+            token = await call_twitter(url_builder.get_guest_token())
+            guest_token = token['guest_token']
+            guest_token_expires = time.monotonic() + GUEST_TOKEN_TTL
+        return guest_token
 
-        data = await _call(builder.user_tweets(user_id=user_id, replies=False, cursor=None))
+
+async def get_tweets(user_id: int) -> List[Tweet]:
+    token = await get_guest_token()
+    try:
+        url_builder.guest_token = token
+        data = await call_twitter(url_builder.user_tweets(user_id=user_id, replies=False, cursor=None))
+    except ClientResponseError as e:
+        if e.status not in (401, 403, 429):
+            raise
+        url_builder.guest_token = await get_guest_token(stale=token)
+        data = await call_twitter(url_builder.user_tweets(user_id=user_id, replies=False, cursor=None))
 
     result = list()
     for entry in UserTweets._get_entries(data):
@@ -103,27 +204,36 @@ async def get_tweets(user_id: int) -> List[Tweet]:
 
 async def forward_tweets():
     while True:
-        to_send = list()
-        for chat in chats.values():
-            results = await asyncio.gather(*list(map(get_tweets, chat.subscriptions.values())))
-            for tweets, (user_name, user_id) in zip(results, chat.subscriptions.items()):
-                filters = chat.filters.get(user_name, [])
-
-                last_sent = chat.last_sent_id.get(str(user_id), 0)
-                tweets = filter(lambda x: x.media, tweets)
-                tweets = filter(lambda x: int(x.id) > last_sent, tweets)
-                tweets = filter(lambda x: not filters or any(map(lambda term: term.lower() in x.text.lower(), filters)),
-                                tweets)
-
-                for tweet in tweets:
-                    to_send.append((chat, tweet, user_id))
-
-        for chat, tweet, user_id in reversed(to_send):
-            await send_tweet(tweet, chat)
-            chat.last_sent_id[str(user_id)] = max(int(tweet.id), chat.last_sent_id.get(str(user_id), 0))
-
-        if to_send:
-            serialize()
+        await send_queue.join()
+
+        to_send = dict()
+        subscriptions = [(chat, user_name, user_id)
+                         for chat in chats.values()
+                         for user_name, user_id in chat.subscriptions.items()]
+        user_ids = list({user_id for _, _, user_id in subscriptions})
+        results = dict(zip(user_ids, await asyncio.gather(*map(get_tweets, user_ids), return_exceptions=True)))
+        for user_id, tweets in results.items():
+            if isinstance(tweets, BaseException):
+                logging.error("Fetching tweets for %s failed", user_id, exc_info=tweets)
+
+        for chat, user_name, user_id in subscriptions:
+            tweets = results[user_id]
+            if isinstance(tweets, BaseException):
+                continue
+            filters = [term.lower() for term in chat.filters.get(user_name, [])]
+
+            last_sent = chat.last_sent_id.get(str(user_id), 0)
+            chat_to_send = to_send.setdefault(chat.id, [])
+            for tweet in reversed(tweets):
+                if int(tweet.id) <= last_sent or not tweet.media:
+                    continue
+                if not matches_filters(tweet.text, filters):
+                    continue
+                chat_to_send.append((chat, tweet, user_id))
+
+        for chat_to_send in to_send.values():
+            if chat_to_send:
+                send_queue.put_nowait(chat_to_send)
 
         await asyncio.sleep(60)
 
@@ -137,14 +247,14 @@ async def subscription_loop():
         except asyncio.CancelledError:
             break
         except:
-            logging.exception(f"Subscription loop failed")
+            logging.exception("Subscription loop failed")
             await asyncio.sleep(1)
 
 
 @dp.message_handler(commands=['edit'])
 async def edit_rules(message: types.Message):
     markup = types.InlineKeyboardMarkup()
-    chat = chats[str(message.chat.id)]
+    chat = chats[message.chat.id]
     for name in chat.subscriptions.keys():
         markup.add(
             types.InlineKeyboardButton(
@@ -158,7 +268,7 @@ async def edit_rules(message: types.Message):
 @dp.callback_query_handler(edit_subscription.filter(action='edit'))
 async def edit_rule(query: types.CallbackQuery, callback_data: Dict[str, str]):
     await query.answer(f"Editing filters for subscription {callback_data['name']}")
-    chat = chats[str(callback_data['chat_id'])]
+    chat = chats[int(callback_data['chat_id'])]
 
     markup = types.InlineKeyboardMarkup()
     for idx, filter_term in enumerate(chat.filters.get(callback_data['name'], [])):
@@ -191,35 +301,35 @@ async def edit_rule(query: types.CallbackQuery, callback_data: Dict[str, str]):
 
 @dp.callback_query_handler(edit_subscription.filter(action='delete'))
 async def delete_subscription(query: types.CallbackQuery, callback_data: Dict[str, str]):
-    chat = chats[str(callback_data['chat_id'])]
+    chat = chats[int(callback_data['chat_id'])]
     if callback_data['name'] in chat.filters:
         chat.filters.pop(callback_data['name'])
     chat.subscriptions.pop(callback_data['name'])
-    serialize()
+    chats_dirty.set()
     await query.message.reply(f"Removed {callback_data['name']} from subscriptions")
 
 
 @dp.callback_query_handler(edit_filter.filter(action='add'))
 async def add_filter(query: types.CallbackQuery, callback_data: Dict[str, str]):
     await query.message.reply(f"Send your filter text")
-    chat = chats[str(callback_data['chat_id'])]
+    chat = chats[int(callback_data['chat_id'])]
     chat.awaiting_filter = callback_data['subscription']
-    serialize()
+    chats_dirty.set()
 
 
 @dp.callback_query_handler(edit_filter.filter(action='delete'))
 async def delete_filter(query: types.CallbackQuery, callback_data: Dict[str, str]):
-    chat = chats[str(callback_data['chat_id'])]
+    chat = chats[int(callback_data['chat_id'])]
     chat.filters[callback_data['subscription']].pop(int(callback_data['idx']))
-    serialize()
+    chats_dirty.set()
     await query.message.reply(f"Removed {callback_data['idx']} index from filters")
 
 
 @dp.message_handler(commands=['search'])
 async def search_menu(message: types.Message):
-    if str(message.chat.id) not in chats:
-        chats[str(message.chat.id)] = Chat(id=message.chat.id, last_sent_id={}, subscriptions={})
-    chat = chats[str(message.chat.id)]
+    if message.chat.id not in chats:
+        chats[message.chat.id] = Chat(id=message.chat.id, last_sent_id={}, subscriptions={})
+    chat = chats[message.chat.id]
     if not chat.subscriptions:
         return await message.reply(f"You have not set up any rules, paste text in the chat to add a rule")
 
@@ -238,27 +348,26 @@ async def search_menu(message: types.Message):
 async def search_by_rule(query: types.CallbackQuery, callback_data: Dict[str, str]):
     await query.answer(f"Fetching tweets")
 
-    chat = chats[str(callback_data['chat_id'])]
+    chat = chats[int(callback_data['chat_id'])]
     subscription = chat.subscriptions[callback_data['subscription']]
-    filters = chat.filters.get(callback_data['subscription'], [])
-
-    api = Twitter()
+    filters = [term.lower() for term in chat.filters.get(callback_data['subscription'], [])]
 
-    for tweet in api.get_tweets(subscription):
+    for tweet in await get_tweets(subscription):
         if not tweet.media:
             continue
 
-        if not filters or any(map(lambda term: term.lower() in tweet.text.lower(), filters)):
-            await send_tweet(tweet, chat)
+        if matches_filters(tweet.text, filters):
+            await send_tweet_limited(tweet, chat)
             break
 
 
 @dp.message_handler()
 async def handle_input(message: types.Message) -> None:
-    if str(message.chat.id) not in chats:
-        chats[str(message.chat.id)] = Chat(id=message.chat.id, last_sent_id={}, subscriptions={})
+    global twitter
+    if message.chat.id not in chats:
+        chats[message.chat.id] = Chat(id=message.chat.id, last_sent_id={}, subscriptions={})
 
-    chat = chats[str(message.chat.id)]
+    chat = chats[message.chat.id]
 
     if chat.awaiting_filter:
         chat.filters[chat.awaiting_filter] = chat.filters.get(chat.awaiting_filter, []) + [message.text]
@@ -266,17 +375,43 @@ async def handle_input(message: types.Message) -> None:
         await message.reply(f"Successfully added filter {message.text}")
     else:
         try:
-            chat.subscriptions[message.text] = Twitter().get_user_info(message.text).rest_id
-            await message.reply(f"Successfully added subscription {message.text}")
+            user = get_twitter().get_user_info(message.text)
+        except (GuestTokenNotFound, InvalidCredentials, UnknownError) as e:
+            # guest token rejected or rate limited, build a fresh client next time
+            twitter = None
+            await message.reply(str(e))
         except Exception as e:
             await message.reply(str(e))
+        else:
+            chat.subscriptions[message.text] = user.rest_id
+            await message.reply(f"Successfully added subscription {message.text}")
+
+    chats_dirty.set()
+
+
+async def on_startup(_: Dispatcher):
+    global session
+    session = ClientSession(
+        connector=TCPConnector(limit_per_host=MAX_CONCURRENT_REQUESTS, keepalive_timeout=120, ttl_dns_cache=300))
+    loop = asyncio.get_event_loop()
+    # the executor runs on_shutdown once run_forever returns
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    background_tasks.append(loop.create_task(subscription_loop()))
+    background_tasks.extend(loop.create_task(send_loop()) for _ in range(SEND_WORKERS))
+    # created last so it is stopped last and flushes everything the others changed
+    background_tasks.append(loop.create_task(serialize_loop()))
+
 
-    serialize()
+async def on_shutdown(_: Dispatcher):
+    for task in background_tasks:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    await session.close()
 
 
 if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)s:%(levelname)s:%(name)s:%(message)s')
     logging.getLogger().setLevel(logging.INFO)
+    uvloop.install()
     deserialize()
-    asyncio.get_event_loop().create_task(subscription_loop())
-    executor.start_polling(dp, skip_updates=True)
+    executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)